@@ -29,33 +29,179 @@ porting (Input and Output) using mido library, clock timings, and parsing
 to piano roll matrix using numpy library.
 """
 
+import array
 import mido
 import time
+import threading
+import queue
 import numpy as np
 import matplotlib.pyplot as plt
+import numba
+import scipy.sparse as sp
+
+
+@numba.njit(cache=True, boundscheck=False)
+def _add_span(spans, count, length, start, stop, note, velocity):
+    """Appends a note to spans, clipped to the sequence length."""
+    start = max(start, 0)
+    stop = min(stop, length)
+    if stop <= start:
+        return count
+    spans[count, 0] = start
+    spans[count, 1] = stop
+    spans[count, 2] = note
+    spans[count, 3] = velocity
+    return count + 1
+
+
+@numba.njit(cache=True, boundscheck=False)
+def _note_spans(events, bounds, length):
+    """Pairs MIDI note events to notes.
+
+    Every note on is held until the next event of the same pitch. The events
+    are sorted by pitch, so the events of each pitch are a contiguous run and
+    only the currently open note of that pitch has to be tracked.
+
+    Args:
+        events: Matrix of size (n,4) with rows (tick, status, note, velocity)
+        sorted by note, then tick.
+        bounds: Array of size 129, the events of note p are
+        events[bounds[p]:bounds[p+1]].
+        length: Length of the sequence in ticks.
+
+    Returns:
+        spans: Matrix of size (k,4) with rows (start, stop, note, velocity),
+        notes sound from tick start up to but not including tick stop.
+    """
+    spans = np.empty((events.shape[0], 4), dtype=np.int32)
+    count = 0
+    for note in range(128):
+        first = count
+        open_tick = 0
+        open_vel = 0  # 0 if pitch is not sounding
+        for i in range(bounds[note], bounds[note + 1]):
+            tick = events[i, 0]
+            status = events[i, 1]
+            vel = events[i, 3]
+            if status < 128 or status >= 160:
+                continue
+            # note on range in ints (all midi channels 1-16), note on with
+            # velocity 0 is a note off
+            note_on = status >= 144 and vel > 0
+            if open_vel > 0:
+                if note_on:
+                    # retriggered before note off, end where the new note starts
+                    count = _add_span(spans, count, length, open_tick, tick - 1,
+                                      note, open_vel)
+                else:
+                    # the velocity of a note off is its release velocity (often 0
+                    # or constant), the note sounds with the velocity of its note on
+                    count = _add_span(spans, count, length, open_tick, tick + 1,
+                                      note, open_vel)
+                open_vel = 0
+            if note_on:
+                # a new note takes over the ticks it shares with the previous one
+                if count > first and spans[count - 1, 1] > tick - 1:
+                    spans[count - 1, 1] = max(tick - 1, spans[count - 1, 0])
+                open_tick = tick - 1
+                open_vel = vel
+        # notes still held when the sequence ends sound until its last tick
+        if open_vel > 0:
+            count = _add_span(spans, count, length, open_tick, length, note, open_vel)
+    return spans[:count]
+
+
+def _dense_pianoroll(spans, length):
+    """Builds a piano roll matrix of size (128,length) from notes."""
+    starts, stops, notes, vels = spans.T
+    # +velocity where a note starts and -velocity where it stops, a single
+    # cumsum over time then sustains all notes at once
+    diff = np.zeros((128, length + 1), dtype=np.int16)
+    np.add.at(diff, (notes, starts), vels)
+    np.add.at(diff, (notes, stops), -vels)
+    # notes never overlap, so every partial sum is a velocity and fits int8
+    return np.cumsum(diff[:, :length], axis=1, dtype=np.int8)
+
+
+def _sparse_pianoroll(spans, length):
+    """Builds a sparse piano roll matrix of size (128,length) from notes."""
+    starts, stops, notes, vels = spans.T
+    durations = stops - starts
+    offsets = np.cumsum(durations) - durations
+    cols = np.arange(durations.sum()) + np.repeat(starts - offsets, durations)
+    rows = np.repeat(notes, durations)
+    data = np.repeat(vels, durations).astype(np.int8)
+    return sp.coo_matrix((data, (rows, cols)), shape=(128, length)).tocsr()
+
+
+@numba.njit(cache=True, boundscheck=False)
+def _scan_transitions(prediction):
+    """Finds all note on and note off events of a piano roll matrix.
+
+    Args:
+        prediction: Piano roll matrix of size (128,length).
+
+    Returns:
+        events: Event stream as described in LiveParser.build_event_stream.
+    """
+    length = prediction.shape[1]
+    # first pass counts the events, second pass writes them
+    count = 0
+    for p in range(128):
+        sounding = False
+        for t in range(length):
+            if (prediction[p, t] > 0) != sounding:
+                sounding = not sounding
+                count += 1
+        if sounding:
+            count += 1
+    events = np.zeros((count, 4), dtype=np.int32)
+    k = 0
+    for p in range(128):
+        sounding = False
+        for t in range(length + 1):
+            if (t < length and prediction[p, t] > 0) != sounding:
+                sounding = not sounding
+                events[k, 0] = t
+                events[k, 2] = p
+                if sounding:
+                    events[k, 1] = 144
+                    events[k, 3] = prediction[p, t]
+                else:
+                    events[k, 1] = 128
+                k += 1
+    # events were found pitch by pitch, play them tick by tick
+    return events[np.argsort(events[:, 0], kind='mergesort')]
 
 
 class LiveParser:
-    def __init__(self, port=None, bpm=120, ppq=24, bars=0, end_seq_note=127):
+    def __init__(self, port=None, bpm=120, ppq=24, bars=0, end_seq_note=127, verbose=True):
         self.bpm = bpm  # beats per minute
         self.ppq = ppq  # pulses per quarter note
-        self.seconds2tick = 60. / (bpm * ppq)  # seconds to tick conversion
+        self.tick_ns = int(60e9 / (bpm * ppq))  # length of a tick in nanoseconds
         self.current_tick = -1
-        self.sequence = []
-        self.start_time = time.time()
+        # ring buffer of recorded (tick, status, note, velocity) events, written
+        # by the MIDI input thread only, read by parse_to_matrix
+        self.sequence = np.empty((1024, 4), dtype=np.int32)
+        self.sequence_index = array.array('Q', [0, 0])  # (head, tail) of ring buffer
+        self.next_tick_ns = time.monotonic_ns()  # deadline of the next tick
         self.end_seq_note = end_seq_note
         self.bar_length = ppq * 4
         self.bars = bars
         self.seq_length_ticks = self.bar_length * self.bars
         self.counter_metronome = 0
         self.metronome = 0
+        self.verbose = verbose  # print metronome beats on terminal
+        # beats are printed by a separate thread, so the clocks never wait for stdout
+        self.metronome_queue = queue.SimpleQueue()
+        self.metronome_printer = None  # started with the first beat
         self.in_port = port
-        self.current_time = 0.
-        self.temp_tick = 0
         self.out_port = None
+        self.player = None  # player thread of computer_play
+        self.player_error = None  # error that stopped computer_play
         self.human = True
 
-    def open_inport(self, callback_function):
+    def open_inport(self, callback_function, raw=False):
         """Opens MIDI input port which this script listens to.
 
         This method allows you to choose a connected MIDI device and a
@@ -65,15 +211,25 @@ class LiveParser:
             callback_function: The callback function depending on your task,
             e.g. print MIDI messages on terminal --> print_message
             or create list of MIDI notes --> parse_notes
+            raw: If True, opens the port with python-rtmidi directly, so no
+            mido message is created per MIDI message. The callback function
+            then receives raw rtmidi events --> parse_raw. Requires python-rtmidi.
         """
         avail_ports = mido.get_input_names()
         ports_dict = {i: avail_ports[i] for i in range(len(avail_ports))}
         print("These input ports are available: ", ports_dict)
         if not self.in_port:
             port_num = int(input("Which port would you like to use? "))
-            self.in_port = mido.open_input(ports_dict[port_num], callback=callback_function)
+            port_name = ports_dict[port_num]
         else:
-            self.in_port = mido.open_input(self.in_port, callback=callback_function)
+            port_name = self.in_port
+        if raw:
+            import rtmidi
+            self.in_port = rtmidi.MidiIn()
+            self.in_port.open_port(self.in_port.get_ports().index(port_name))
+            self.in_port.set_callback(callback_function)
+        else:
+            self.in_port = mido.open_input(port_name, callback=callback_function)
         print("Using input port: ", self.in_port)
 
     def open_outport(self):
@@ -107,7 +263,7 @@ class LiveParser:
             new_bpm: New BPM you want to run the LiveParser now with.
         """
         self.bpm = new_bpm
-        self.seconds2tick = 60. / (self.bpm * self.ppq)
+        self.tick_ns = int(60e9 / (self.bpm * self.ppq))
 
     def update_bars(self, bars):
         """Updates the number of bars.
@@ -126,7 +282,7 @@ class LiveParser:
 
         This method resets the clock of the LiveParser before it starts listening.
         """
-        self.start_time = time.time()
+        self.next_tick_ns = time.monotonic_ns()
         self.current_tick = -1
         self.metronome = 0
         self.counter_metronome = 0
@@ -135,75 +291,196 @@ class LiveParser:
         """Resets sequence.
 
         This method resets the list of MIDI notes (the sequence) so that the
-        LiveParser can parse a new sequence.
+        LiveParser can parse a new sequence. Only the head of the ring buffer
+        is moved, so it is safe to call while the input port is open.
+        """
+        self.sequence_index[0] = self.sequence_index[1]
+
+    def get_sequence(self):
+        """Returns the recorded sequence of MIDI notes.
+
+        Returns:
+            events: Matrix of size (n,4) with rows (tick, status, note, velocity)
+            in the order they were played.
         """
-        self.sequence = []
+        head, tail = self.sequence_index
+        # read the buffer once, record_note may swap in a grown one meanwhile
+        sequence = self.sequence
+        return sequence[np.arange(head, tail) % len(sequence)]
+
+    def wait_for_tick(self):
+        """Waits until the next tick is due and advances the clock by one tick.
+
+        This method sleeps until shortly before the deadline of the next tick
+        and busy waits for the rest, which is more precise than sleeping alone.
+        Deadlines are absolute, so the clock does not drift.
+
+        Returns:
+            current_tick: The tick the clock advanced to.
+        """
+        monotonic_ns = time.monotonic_ns
+        deadline = self.next_tick_ns
+        remaining = deadline - monotonic_ns()
+        if remaining > 200000:
+            time.sleep((remaining - 150000) * 1e-9)
+        while monotonic_ns() < deadline:
+            pass
+        tick = self.current_tick + 1
+        self.current_tick = tick
+        self.next_tick_ns = deadline + self.tick_ns
+        return tick
 
     def clock(self):
         """This is the clock of the LiveParser.
 
         This method tracks the timing of all played notes. For input and output
-        of MIDI notes.
+        of MIDI notes. Every call waits for the next tick.
         """
-        self.current_time = time.time() - self.start_time
-        self.temp_tick = int(self.current_time / self.seconds2tick)
-        if self.temp_tick > self.current_tick:
-            self.current_tick = self.temp_tick
-            # print("clock {}".format(self.current_tick))
-            if self.current_tick % self.ppq == 0:
-                self.counter_metronome += 1
-        if self.current_tick >= self.seq_length_ticks-1:
-            if self.sequence:
+        tick = self.wait_for_tick()
+        # print("clock {}".format(tick))
+        if tick % self.ppq == 0:
+            self.counter_metronome += 1
+            self.metronome = self.counter_metronome
+            if self.verbose:
+                self.queue_beat()
+        if tick >= self.seq_length_ticks-1:
+            head, tail = self.sequence_index
+            if tail > head:
                 return 1
             else:
                 print("No note was played - starting over!\n")
                 self.reset_clock()
-        if self.counter_metronome > self.metronome:
-            self.metronome = self.counter_metronome
-            print(self.metronome)
 
-    def computer_play(self, prediction):
+    def build_event_stream(self, prediction):
+        """Converts a piano roll matrix to a stream of MIDI events.
+
+        This method finds all note on and note off transitions of the
+        prediction matrix at once, so nothing has to be computed while
+        the notes are played.
+
+        Args:
+            prediction: A piano roll matrix of size (128,length) containing
+            MIDI notes, either a numpy matrix or a scipy.sparse matrix.
+
+        Returns:
+            events: Matrix of size (k,4) with rows (tick, status, note, velocity)
+            sorted by tick. Notes still sounding at the end of the matrix are
+            released one tick after its last column.
+        """
+        if sp.issparse(prediction):
+            prediction = prediction.toarray()
+        if prediction.ndim != 2 or prediction.shape[0] != 128:
+            raise ValueError("Expected a piano roll matrix of size (128,length), "
+                             "got {}".format(prediction.shape))
+        return _scan_transitions(np.ascontiguousarray(prediction))
+
+    def computer_play(self, prediction, block=True):
         """Plays MIDI notes from piano roll matrix.
 
         This method sends MIDI notes found in the prediction matrix to the
         output port which results in the output port synthesizing the notes.
+        The notes are sent from a separate thread.
 
         Args:
-            prediction: A piano roll matrix containing MIDI notes.
+            prediction: A piano roll matrix of size (128,length) containing
+            MIDI notes, either a numpy matrix or a scipy.sparse matrix.
+            block: If False, returns immediately with the running player thread,
+            e.g. to keep a graphical user interface responsive. An error that
+            stopped playing is then kept in player_error.
+
+        Raises:
+            RuntimeError: If a previous computer_play is still playing.
         """
+        if self.player is not None and self.player.is_alive():
+            raise RuntimeError("LiveParser is still playing")
+        messages = self.build_messages(self.build_event_stream(prediction))
         self.human = False
         self.reset_clock()
-        play_tick = -1
-        old_midi_on = np.zeros(1)
-        played_notes = []
-        while True:
-            done = self.computer_clock()
-            if self.current_tick > play_tick:
-                play_tick = self.current_tick
-                midi_on = np.argwhere(prediction[play_tick] > 0)
-                if midi_on.any():
-                    for note in midi_on[0]:
-                        if note not in old_midi_on:
-                            current_vel = int(prediction[self.current_tick,note])
-                            # print(current_vel)
-                            self.out_port.send(mido.Message('note_on',
-                                                note=note, velocity=current_vel))
-                            played_notes.append(note)
-                else:
-                    for note in played_notes:
-                        self.out_port.send(mido.Message('note_off', note=note))
-                        played_notes.pop(0)
-
-                if old_midi_on.any():
-                    for note in old_midi_on[0]:
-                        if note not in midi_on:
-                            self.out_port.send(mido.Message('note_off', note=note))
-                old_midi_on = midi_on
-
-            if done:
-                self.human = True
-                self.reset_clock()
-                break
+        self.player_error = None
+        self.player = threading.Thread(target=self.run_player, args=(messages,),
+                                       daemon=True)
+        self.player.start()
+        if not block:
+            return self.player
+        self.player.join()
+        if self.player_error is not None:
+            raise self.player_error
+
+    def run_player(self, messages):
+        """Runs play_messages on the player thread of computer_play.
+
+        Keeps the error that stopped playing in player_error, so that
+        computer_play can raise it in the calling thread.
+
+        Args:
+            messages: List with the list of mido messages of every tick,
+            see build_messages.
+        """
+        try:
+            self.play_messages(messages)
+        except Exception as error:
+            self.player_error = error
+
+    def build_messages(self, events):
+        """Converts a stream of MIDI events to mido messages grouped by tick.
+
+        This method creates all messages before playing, so that playing
+        a tick only has to send the messages that are already there.
+
+        Args:
+            events: Matrix of size (k,4) with rows (tick, status, note, velocity)
+            sorted by tick, see build_event_stream.
+
+        Returns:
+            messages: List with the list of mido messages of every tick.
+        """
+        messages = [[] for _ in range(events[-1, 0] + 1 if len(events) else 0)]
+        for tick, status, note, velocity in events.tolist():
+            if status >= 144:
+                messages[tick].append(mido.Message('note_on', note=note, velocity=velocity))
+            else:
+                messages[tick].append(mido.Message('note_off', note=note))
+        return messages
+
+    def play_messages(self, messages):
+        """Sends mido messages to the output port in time.
+
+        This method is run by the player thread of computer_play. The messages
+        of every tick are sent as soon as the clock reaches the tick.
+
+        Args:
+            messages: List with the list of mido messages of every tick,
+            see build_messages.
+        """
+        send = self.out_port.send
+        failed = True
+        try:
+            while True:
+                done = self.computer_clock()
+                tick = self.current_tick
+                if tick < len(messages):
+                    for msg in messages[tick]:
+                        send(msg)
+                if done:
+                    break
+            failed = False
+        finally:
+            stop_tick = self.current_tick
+            self.human = True
+            self.reset_clock()
+            # release all notes that are still sounding when playing stops
+            sounding = {}
+            for tick_messages in messages[:stop_tick + 1]:
+                for msg in tick_messages:
+                    sounding[msg.note] = msg.type == 'note_on'
+            try:
+                for note, on in sounding.items():
+                    if on:
+                        send(mido.Message('note_off', note=note))
+            except Exception:
+                # do not hide the error that stopped playing
+                if not failed:
+                    raise
 
     def computer_clock(self):
         """This is another clock of the LiveParser.
@@ -211,18 +488,37 @@ class LiveParser:
         This method allows to track the timing when a matrix is played with
         computer_play method.
         """
-        self.current_time = time.time() - self.start_time
-        self.temp_tick = int(self.current_time / self.seconds2tick)
-        if self.temp_tick > self.current_tick:
-            self.current_tick = self.temp_tick
-            # print("clock {}".format(self.current_tick))
-            if self.current_tick % self.ppq == 0:
-                self.counter_metronome += 1
-        if self.current_tick >= self.seq_length_ticks-1:
-            return 1
-        if self.counter_metronome > self.metronome:
+        tick = self.wait_for_tick()
+        # print("clock {}".format(tick))
+        if tick % self.ppq == 0:
+            self.counter_metronome += 1
             self.metronome = self.counter_metronome
-            print(self.metronome)
+            if self.verbose:
+                self.queue_beat()
+        if tick >= self.seq_length_ticks-1:
+            return 1
+
+    def queue_beat(self):
+        """Queues the current metronome beat for print_metronome.
+
+        Starts the printing thread with the first beat, so LiveParsers that
+        never run a clock do not start one.
+        """
+        if self.metronome_printer is None:
+            self.metronome_printer = threading.Thread(target=self.print_metronome,
+                                                      daemon=True)
+            self.metronome_printer.start()
+        self.metronome_queue.put(self.metronome)
+
+    def print_metronome(self):
+        """Prints metronome beats on terminal.
+
+        This method is run by a separate thread, started with the first beat
+        of a verbose LiveParser, and prints the beats the clocks put in the
+        metronome queue.
+        """
+        while True:
+            print(self.metronome_queue.get())
 
     def print_message(self, msg):
         """Prints MIDI message in MIDI format.
@@ -250,47 +546,76 @@ class LiveParser:
         Args:
             message: message for callback function
         """
-        msg = message.bytes()
+        # only append midi on and midi off notes, read the fields directly
+        # instead of allocating a list with message.bytes()
+        msg_type = message.type
+        if msg_type == 'note_on':
+            self.record_note(144 | message.channel, message.note, message.velocity)
+        elif msg_type == 'note_off':
+            self.record_note(128 | message.channel, message.note, message.velocity)
+
+        # TODO could be extended to use midi control changes like pitch bend etc.
+
+    def parse_raw(self, event, data=None):
+        """Tracks notes that are played when metronome is running.
+
+        Same as parse_notes for ports opened with open_inport(raw=True).
+        Reads the status byte of the raw message directly instead of
+        building a mido message first.
+
+        Args:
+            event: (message, delta time) tuple of the rtmidi callback
+            data: user data of the rtmidi callback, unused
+        """
+        msg = event[0]
         # only append midi on and midi off notes
         if 128 <= msg[0] < 160:
-            self.sequence.append([self.current_tick, msg[0], msg[1], msg[2]])
+            self.record_note(msg[0], msg[1], msg[2])
 
-        # TODO could be extended to use midi control changes like pitch bend etc.
+    def record_note(self, status, note, velocity):
+        """Appends a MIDI note at the current tick to the sequence.
 
-    def parse_to_matrix(self):
-        """Parses sequence of MIDI notes to a matrix of size (length,128).
+        Args:
+            status: status byte of the MIDI message
+            note: MIDI note number
+            velocity: MIDI velocity
+        """
+        head, tail = self.sequence_index
+        sequence = self.sequence
+        if tail - head == len(sequence):
+            # double the ring buffer when full, the reader only ever sees a
+            # buffer that holds all events up to the tail it has read
+            grown = np.empty((2 * len(sequence), 4), dtype=sequence.dtype)
+            index = np.arange(head, tail)
+            grown[index % len(grown)] = sequence[index % len(sequence)]
+            self.sequence = sequence = grown
+        sequence[tail % len(sequence)] = (self.current_tick, status, note, velocity)
+        self.sequence_index[1] = tail + 1
+
+    def parse_to_matrix(self, sparse=False):
+        """Parses sequence of MIDI notes to a matrix of size (128,length).
 
         This method parses the previously recorded MIDI notes to
         a piano roll (numpy) matrix.
 
+        Args:
+            sparse: If True, returns a scipy.sparse CSR matrix instead of a
+            dense numpy matrix. Piano rolls are mostly zeros, so this saves
+            memory for long sequences.
+
         Returns:
             pianoroll: A piano roll matrix that was recorded when the LiveParser
-            was listening.
+            was listening. Entries are int8 MIDI velocities.
         """
         # print("Parsing...")
-        pianoroll = np.zeros((self.seq_length_ticks, 128))
-
-        for note in self.sequence:
-            # print(note)
-            # note on range in ints (all midi channels 1-16)
-            if 144 <= note[1] < 160:
-                pianoroll[note[0]-1, note[2]] = note[3]
-            # note off range in ints (all midi channels 1-16)
-            elif 128 <= note[1] < 144:
-                try:
-                    note_on_entry = np.argwhere(pianoroll[:note[0],note[2]])[-1][0]
-                    # print(note_on_entry)
-                except:
-                    note_on_entry = 0
-                # some midi instruments send note off message with 0 or constant velocity
-                # use the velocity of the corresponding note on message
-                # TODO USE VELOCITY OF NOTE ON MESSAGE
-                # BUGGY, throws error if you play a note on the last midi tick of the sequence
-                if note[3] == 0:
-                    last_velocity = pianoroll[note_on_entry, note[2]]
-                    pianoroll[note_on_entry+1:note[0]+1, note[2]] = last_velocity
-                else:
-                    pianoroll[note_on_entry+1:note[0]+1, note[2]] = note[3]
+        events = self.get_sequence()
+        # sort by note, then tick, notes played at the same tick keep their order
+        events = events[np.lexsort((events[:, 0], events[:, 2]))]
+        bounds = np.searchsorted(events[:, 2], np.arange(129))
+        spans = _note_spans(events, bounds, self.seq_length_ticks)
+        if sparse:
+            return _sparse_pianoroll(spans, self.seq_length_ticks)
+        pianoroll = _dense_pianoroll(spans, self.seq_length_ticks)
 
         return pianoroll
 
@@ -311,5 +636,5 @@ if __name__ == '__main__':
             sequence = midi.parse_to_matrix()
             break
     # show results
-    plt.imshow(sequence.transpose(1,0), origin='lower')
+    plt.imshow(sequence, origin='lower')
     plt.show()